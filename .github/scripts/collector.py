@@ -1,11 +1,25 @@
+import hashlib
+import html
+import json
 import logging
 import os
+import posixpath
+import re
+import shutil
 import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
-from ebooklib import epub
-from bs4 import BeautifulSoup
+from urllib.parse import unquote
+from lxml import etree
 import markdown2
 
+# orjson 的序列化速度远快于标准库 json，未安装时退回到 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # 设置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', stream=sys.stdout)
 
@@ -21,47 +35,155 @@ SRC_BASE = Path(SOURCE_REPO_PATH_STR)
 DST_BASE = Path(OUTPUT_PATH_STR)
 SRC = SRC_BASE / "01_economist"
 DST_ARTICLES = DST_BASE / "articles"
+# 文章清单 {杂志名: {"hash": EPUB 内容摘要, "files": [文件名, ...], "titles": [标题, ...]}}，
+# 用于跳过未变化的杂志和生成索引页
+MANIFEST_PATH = DST_ARTICLES / ".manifest.json"
 
 logging.info(f"源文件目录: {SRC}")
 logging.info(f"文章输出目录: {DST_ARTICLES}")
 logging.info(f"静态网站根目录: {DST_BASE}")
 
+# 文件名中不允许出现的字符（与 str.isalnum() 加 " _-" 的白名单等价）
+UNSAFE_FILENAME_CHARS = re.compile(r'[^\w _-]')
+
+# 查找标题时每次喂给解析器的字节数；找到第一个 h1 后剩余内容不再解析
+TITLE_SCAN_CHUNK = 4096
+
+# 复用同一个 Markdown 转换器，避免每篇文章都重新初始化扩展和正则；convert() 每次调用前会自行重置状态
+MARKDOWN = markdown2.Markdown(extras=["fenced-code-blocks"])
+
+# EPUB 容器与 OPF 包文件使用的 XML 命名空间
+CONTAINER_NS = "urn:oasis:names:tc:opendocument:xmlns:container"
+OPF_NS = "http://www.idpf.org/2007/opf"
+
+# 索引页中固定不变的首尾部分，生成时只需拼接中间的文章列表
+INDEX_HEAD = "<html><body><h1>文章列表</h1><ul>"
+INDEX_FOOT = "</ul></body></html>"
+
+def iter_epub_documents(epub_path: Path):
+    """按 OPF 清单顺序直接从 ZIP 中读取 XHTML 文档，逐个产出 (文档名, 内容)；
+    图片、样式等其他资源不会被解压"""
+    with zipfile.ZipFile(epub_path) as zf:
+        container = etree.fromstring(zf.read("META-INF/container.xml"))
+        opf_path = container.find(f".//{{{CONTAINER_NS}}}rootfile").get("full-path")
+        opf_dir = posixpath.dirname(opf_path)
+        opf = etree.fromstring(zf.read(opf_path))
+        for entry in opf.iterfind(f"{{{OPF_NS}}}manifest/{{{OPF_NS}}}item"):
+            if entry.get("media-type") != "application/xhtml+xml":
+                continue
+            name = unquote(entry.get("href"))
+            # href 相对于 OPF 所在目录，可能带有 "../" 或 "./"，需规范化后才是 ZIP 中的成员名
+            yield name, zf.read(posixpath.normpath(posixpath.join(opf_dir, name)))
+
+def iter_headings(content: bytes):
+    """分块流式解析文档，按出现顺序产出解析完成的 h1/h2 元素"""
+    # 注释和处理指令在 C 层直接丢弃，不为它们构建节点；
+    # libxml2 的 HTML 解析器默认按 Latin-1 解码，需显式指定与正文一致的 UTF-8
+    parser = etree.HTMLPullParser(events=('end',), tag=('h1', 'h2'), remove_comments=True, remove_pis=True, recover=True, encoding='utf-8')
+    for start in range(0, len(content), TITLE_SCAN_CHUNK):
+        parser.feed(content[start:start + TITLE_SCAN_CHUNK])
+        for _, element in parser.read_events():
+            yield element
+    parser.close()
+    for _, element in parser.read_events():
+        yield element
+
+def find_title(content: bytes):
+    """返回文档中第一个 h1（没有则取 h2）的文本，找不到标题时返回 None；读到第一个 h1 即停止解析"""
+    first_h2 = None
+    try:
+        for element in iter_headings(content):
+            if element.tag == 'h1':
+                return ''.join(element.itertext())
+            if first_h2 is None:
+                first_h2 = ''.join(element.itertext())
+    except etree.LxmlError:
+        # 空文档等 lxml 在 recover 模式下仍无法解析的内容
+        pass
+    return first_h2
+
+def scan_files(root: Path, suffix: str):
+    """用 os.scandir 递归查找 root 下指定后缀的文件，跳过隐藏目录"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            # DirEntry 的类型信息来自 readdir，判断时不需要额外的 stat 调用
+            if entry.is_dir(follow_symlinks=False):
+                if not entry.name.startswith('.'):
+                    yield from scan_files(Path(entry.path), suffix)
+            elif entry.name.lower().endswith(suffix):
+                yield Path(entry.path)
+
+def file_digest(path: Path) -> str:
+    """分块计算文件内容的 BLAKE2b 摘要"""
+    digest = hashlib.blake2b(digest_size=16)
+    with path.open('rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_manifest(manifest_path: Path) -> dict:
+    """读取文章清单，文件不存在或已损坏时返回空清单"""
+    try:
+        data = manifest_path.read_bytes()
+        return orjson.loads(data) if orjson else json.loads(data)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest_path: Path, manifest: dict):
+    """以 UTF-8 JSON 写出文章清单"""
+    data = orjson.dumps(manifest) if orjson else json.dumps(manifest, ensure_ascii=False).encode('utf-8')
+    manifest_path.write_bytes(data)
+
 def epub_to_md(epub_path: Path, out_dir: Path):
-    """将单个 EPUB 文件转换为多个 Markdown 文章"""
+    """将单个 EPUB 文件转换为多个 Markdown 文章，返回写出的文章清单；失败时返回 None"""
     try:
         if not epub_path.is_file(): return
-        book = epub.read_epub(epub_path)
         out_dir.mkdir(parents=True, exist_ok=True)
-        for item in book.get_items_of_type(epub.EpubHtml):
-            content = item.get_content()
-            soup = BeautifulSoup(content, 'html.parser')
-            title_tag = soup.find('h1') or soup.find('h2')
-            file_name_base = "".join(x for x in (title_tag.text if title_tag else Path(item.get_name()).stem) if x.isalnum() or x in " _-").strip()
-            md_content = markdown2.markdown(str(soup), extras=["metadata", "fenced-code-blocks"])
+        written = {}
+        for item_name, content in iter_epub_documents(epub_path):
+            title = find_title(content)
+            if title is None:
+                title = Path(item_name).stem
+            file_name_base = UNSAFE_FILENAME_CHARS.sub('', title).strip()
+            md_content = MARKDOWN.convert(content.decode('utf-8', errors='replace'))
             md_file_path = out_dir / f"{file_name_base}.md"
-            md_file_path.write_text(md_content, encoding='utf-8')
-            logging.info(f"已转换 '{epub_path.name}' 中的 '{item.get_name()}'")
+            md_file_path.write_bytes(md_content.encode('utf-8'))
+            written[md_file_path.name] = title.strip()
+            logging.info(f"已转换 '{epub_path.name}' 中的 '{item_name}'")
+        # 同名标题会覆盖先前的文件，清单里只保留最后写入的一份
+        return {"files": list(written), "titles": list(written.values())}
     except Exception as e:
         logging.error(f"处理 EPUB 文件 '{epub_path.name}' 时发生错误: {e}")
 
-def generate_website(articles_dir: Path, output_dir: Path):
-    """根据 Markdown 文章生成一个简单的静态网站"""
+def generate_website(articles_dir: Path, output_dir: Path, manifest: dict = None):
+    """根据 Markdown 文章生成一个简单的静态网站；有文章清单时直接使用，不再遍历文章目录"""
     if not articles_dir.exists():
         logging.warning("文章目录不存在，跳过网站生成。")
         (output_dir / "index.html").write_text("<h1>暂无文章</h1>", encoding='utf-8')
         return
 
     index_html_path = output_dir / "index.html"
-    html_content = "<html><body><h1>文章列表</h1><ul>"
-    article_files = sorted(list(articles_dir.rglob("*.md")))
-    if not article_files:
-        html_content += "<li>No articles found.</li>"
+    # 清单中已记录了写入时的标题，无需再逐个读取文章文件
+    if manifest:
+        # 清单按列存储文件名与标题，这里同样用平行列表收集，只对下标排序；
+        # 排序键（杂志名 + casefold 后的标题）预先算好，不再逐次比较 Path 对象
+        md_files, titles, sort_keys = [], [], []
+        for magazine_name, magazine_entry in manifest.items():
+            magazine_dir = articles_dir / magazine_name
+            md_files.extend(magazine_dir / file_name for file_name in magazine_entry["files"])
+            titles.extend(magazine_entry["titles"])
+            sort_keys.extend((magazine_name, title.casefold()) for title in magazine_entry["titles"])
+        order = sorted(range(len(sort_keys)), key=sort_keys.__getitem__)
+        articles = [(md_files[i], titles[i]) for i in order]
+    else:
+        articles = [(md_file, md_file.stem) for md_file in sorted(scan_files(articles_dir, ".md"))]
+    # 先收集所有列表项再一次性拼接，避免在循环里反复复制整个 HTML 字符串
+    if not articles:
+        items = ["<li>No articles found.</li>"]
     else:
-        for md_file in article_files:
-            relative_path = md_file.relative_to(output_dir)
-            html_content += f'<li><a href="{relative_path}">{md_file.stem}</a></li>\n'
-    html_content += "</ul></body></html>"
-    index_html_path.write_text(html_content, encoding='utf-8')
+        items = [f'<li><a href="{md_file.relative_to(output_dir)}">{html.escape(title)}</a></li>\n' for md_file, title in articles]
+    html_content = INDEX_HEAD + "".join(items) + INDEX_FOOT
+    index_html_path.write_bytes(html_content.encode('utf-8'))
     logging.info(f"网站索引页已生成: {index_html_path}")
 
 def main():
@@ -72,15 +194,51 @@ def main():
         logging.error(f"源目录 '{SRC}' 不存在或不是一个目录。")
         sys.exit(1)
 
-    epub_files = list(SRC.glob("*.epub"))
+    manifest = load_manifest(MANIFEST_PATH)
+    # 每期杂志位于 SRC 下各自的子目录中，需要递归查找
+    epub_files = sorted(scan_files(SRC, ".epub"))
+    # 文章目录会在运行之间保留，源仓库中已删除或改名的杂志需要从清单和输出中移除，
+    # 使网站与本次检出的内容保持一致
+    current_magazines = {epub_file.stem for epub_file in epub_files}
+    stale_magazines = [magazine_name for magazine_name in manifest if magazine_name not in current_magazines]
+    for magazine_name in stale_magazines:
+        shutil.rmtree(DST_ARTICLES / magazine_name, ignore_errors=True)
+        del manifest[magazine_name]
+        logging.info(f"'{magazine_name}' 已不在源目录中，删除其文章。")
+    pending_files, pending_dirs, pending_hashes = [], [], []
     if not epub_files:
         logging.warning(f"在 '{SRC}' 中未找到 EPUB 文件。")
     else:
-        for epub_file in epub_files:
+        # 按内容摘要而不是 mtime 判断是否变化：CI 每次重新检出源仓库，文件的 mtime 都是新的。
+        # 计算摘要以读文件为主，hashlib 在处理大块数据时会释放 GIL，用线程池并行读取
+        with ThreadPoolExecutor() as executor:
+            epub_hashes = list(executor.map(file_digest, epub_files))
+        for epub_file, epub_hash in zip(epub_files, epub_hashes):
             magazine_name = epub_file.stem
             article_output_dir = DST_ARTICLES / magazine_name
-            epub_to_md(epub_file, article_output_dir)
-    generate_website(DST_ARTICLES, DST_BASE)
+            if manifest.get(magazine_name, {}).get("hash") == epub_hash and article_output_dir.is_dir():
+                logging.info(f"'{epub_file.name}' 未变化，跳过转换。")
+                continue
+            # 只读 ZIP 尾部目录即可排除未拉取的 Git LFS 指针等非 EPUB 文件，省去完整解析的开销
+            if not zipfile.is_zipfile(epub_file):
+                logging.warning(f"'{epub_file.name}' 不是有效的 EPUB（ZIP）文件，跳过。")
+                continue
+            pending_files.append(epub_file)
+            pending_dirs.append(article_output_dir)
+            pending_hashes.append(epub_hash)
+        # 每本杂志的解析互不相关且受 CPU 限制，分发到多个进程并行转换；
+        # 各进程只写入自己的杂志目录，互不冲突
+        if pending_files:
+            # 日常运行通常只有一两期新杂志，进程数不超过待转换的文件数，避免启动空闲进程
+            max_workers = min(len(pending_files), os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(epub_to_md, pending_files, pending_dirs)
+                for epub_file, epub_hash, magazine_articles in zip(pending_files, pending_hashes, results):
+                    if magazine_articles is not None:
+                        manifest[epub_file.stem] = {"hash": epub_hash, **magazine_articles}
+    if stale_magazines or pending_files:
+        save_manifest(MANIFEST_PATH, manifest)
+    generate_website(DST_ARTICLES, DST_BASE, manifest)
     logging.info("--- 收集器脚本执行完毕 ---")
 
 if __name__ == '__main__':